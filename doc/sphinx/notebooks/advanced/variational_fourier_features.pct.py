@@ -24,8 +24,13 @@
 # We cannot directly use Fourier features within the multi-output framework without losing the computational advantages, as `Kuu` and `Kuf` for SharedIndependent and SeparateIndependent inducing variables assume that the sub-inducing variable's covariances are simply computed as dense Tensors. However, there is nothing preventing a dedicated implementation of multi-output Fourier features that is computationally more efficient - feel free to discuss this within [the GPflow community](https://github.com/GPflow/GPflow/#the-gpflow-community)!
 
 # %%
+import inspect
+import os
+from collections import namedtuple
+
 import numpy as np
 import tensorflow as tf
+from packaging.version import Version
 
 import gpflow
 from gpflow import covariances as cov
@@ -36,12 +41,237 @@ from gpflow.experimental.check_shapes import Shape
 from gpflow.inducing_variables import InducingVariables
 from gpflow.utilities import to_default_float
 
+# %% [markdown]
+# VFF give structured covariance matrices that are computationally efficient: `Kuu` is block-diagonal, with a cosine block and a sine block that are each a diagonal matrix plus (at most) a rank-one update. We take advantage of this with a dedicated TensorFlow `LinearOperator` that solves via the Sherman–Morrison formula and computes the log-determinant via the matrix determinant lemma, both in $\mathcal{O}(M)$ instead of the $\mathcal{O}(M^3)$ of a Cholesky decomposition:
+
 # %%
-# VFF give structured covariance matrices that are computationally efficient.
-# We take advantage of this using TensorFlow's LinearOperators:
-BlockDiag = tf.linalg.LinearOperatorBlockDiag
-Diag = tf.linalg.LinearOperatorDiag
-LowRank = tf.linalg.LinearOperatorLowRankUpdate
+class _DiagPlusRank1:
+    """
+    A block diag(d) + v vᵀ of Kuu, where `v` may be None (just diagonal).
+
+    The Sherman–Morrison terms Bu = v / d and denom = 1 + vᵀ Bu are computed
+    once and reused by every solve, the log-determinant and the inverse:
+
+        (diag(d) + v vᵀ)⁻¹ = diag(1/d) - Bu Buᵀ / denom
+        det(diag(d) + v vᵀ) = det(diag(d)) denom
+    """
+
+    def __init__(self, d, v=None):
+        self.d = d
+        self.v = v
+        if v is not None:
+            self.Bu = v / d
+            self.denom = 1.0 + tf.reduce_sum(v * self.Bu)
+
+    def matmul(self, x):
+        y = self.d[:, None] * x
+        if self.v is None:
+            return y
+        return y + self.v[:, None] * tf.matmul(self.v[None, :], x)
+
+    def solve(self, rhs):
+        """ rhs is [..., M, N] """
+        x = rhs / self.d[:, None]
+        if self.v is None:
+            return x
+        # Bu (Buᵀ rhs) keeps this O(M N) rather than O(M² N):
+        BuT_rhs = tf.matmul(self.Bu[None, :], rhs)
+        return x - self.Bu[:, None] * BuT_rhs / self.denom
+
+    def log_abs_determinant(self):
+        logdet = tf.reduce_sum(tf.math.log(self.d))
+        if self.v is None:
+            return logdet
+        return logdet + tf.math.log(self.denom)
+
+    def trace_solve_outer(self, L):
+        """ tr(block⁻¹ L Lᵀ) for L [..., M, N], summed over the last two axes """
+        trace = tf.reduce_sum(tf.square(L) / self.d[:, None], axis=[-1, -2])
+        if self.v is None:
+            return trace
+        # (Buᵀ L) first, then square-sum, to stay O(M N)
+        BuT_L = tf.matmul(self.Bu[None, :], L)
+        return (
+            trace - tf.reduce_sum(tf.square(BuT_L), axis=[-1, -2]) / self.denom
+        )
+
+    def to_dense(self):
+        dense = tf.linalg.diag(self.d)
+        if self.v is None:
+            return dense
+        return dense + self.v[:, None] * self.v[None, :]
+
+    def inverse_to_dense(self):
+        dense = tf.linalg.diag(1.0 / self.d)
+        if self.v is None:
+            return dense
+        return dense - self.Bu[:, None] * self.Bu[None, :] / self.denom
+
+
+def _block_diag(cosine_block, sine_block):
+    return tf.linalg.LinearOperatorBlockDiag(
+        [
+            tf.linalg.LinearOperatorFullMatrix(cosine_block),
+            tf.linalg.LinearOperatorFullMatrix(sine_block),
+        ]
+    ).to_dense()
+
+
+class VFFKuf(namedtuple("VFFKuf", ["cos", "sin"])):
+    """
+    The Kuf of the Fourier features, kept as its cosine [M, N] and sine
+    [M-1, N] row blocks rather than one dense [2M-1, N] matrix, so that the
+    blocks can be combined with the corresponding blocks of Kuu separately.
+
+    In the methods below, `other` is either another VFFKuf or a dense
+    [..., 2M-1, K] tensor, whose rows are split into the same blocks.
+    """
+
+    def split(self, other):
+        if isinstance(other, VFFKuf):
+            return other
+        M = tf.shape(self.cos)[0]
+        return VFFKuf(other[..., :M, :], other[..., M:, :])
+
+    def matmul_transpose(self, other):
+        """ Kufᵀ other """
+        other = self.split(other)
+        return tf.matmul(self.cos, other.cos, transpose_a=True) + tf.matmul(
+            self.sin, other.sin, transpose_a=True
+        )
+
+    def diag_matmul_transpose(self, other):
+        """ diag(Kufᵀ other), without computing the off-diagonal terms """
+        other = self.split(other)
+        return tf.reduce_sum(self.cos * other.cos, axis=-2) + tf.reduce_sum(
+            self.sin * other.sin, axis=-2
+        )
+
+    def left_matmul(self, B):
+        """ B Kuf, for a dense B [..., K, 2M-1] """
+        M = tf.shape(self.cos)[0]
+        return tf.matmul(B[..., :M], self.cos) + tf.matmul(B[..., M:], self.sin)
+
+
+# LinearOperator only takes the `parameters` of its subclasses after TF 2.4:
+_LINEAR_OPERATOR_HAS_PARAMETERS = (
+    "parameters"
+    in inspect.signature(tf.linalg.LinearOperator.__init__).parameters
+)
+
+
+class VFFKuu(tf.linalg.LinearOperator):
+    """
+    The Kuu of the Fourier features,
+
+        Kuu = [diag(d_cos) + v_cos v_cosᵀ, 0                         ]
+              [0,                          diag(d_sin) + v_sin v_sinᵀ]
+
+    where `v_sin` may be None (no low-rank update on the sine block).
+    """
+
+    def __init__(self, d_cos, v_cos, d_sin, v_sin=None, name="VFFKuu"):
+        kwargs = {}
+        if _LINEAR_OPERATOR_HAS_PARAMETERS:
+            kwargs["parameters"] = dict(
+                d_cos=d_cos, v_cos=v_cos, d_sin=d_sin, v_sin=v_sin, name=name
+            )
+        self.cos_block = _DiagPlusRank1(d_cos, v_cos)
+        self.sin_block = _DiagPlusRank1(d_sin, v_sin)
+        super().__init__(
+            dtype=d_cos.dtype,
+            is_non_singular=True,
+            is_self_adjoint=True,
+            is_positive_definite=True,
+            is_square=True,
+            name=name,
+            **kwargs,
+        )
+
+    def _shape(self):
+        M_cos, M_sin = self.cos_block.d.shape[0], self.sin_block.d.shape[0]
+        if M_cos is None or M_sin is None:  # not statically known
+            return tf.TensorShape([None, None])
+        return tf.TensorShape([M_cos + M_sin, M_cos + M_sin])
+
+    def _shape_tensor(self):
+        num_inducing = (
+            tf.shape(self.cos_block.d)[0] + tf.shape(self.sin_block.d)[0]
+        )
+        return tf.stack([num_inducing, num_inducing])
+
+    def _split(self, rhs, adjoint_arg):
+        """ split rhs [..., 2M-1, N] into its cosine and sine rows """
+        if adjoint_arg:
+            rhs = tf.linalg.adjoint(rhs)
+        M = tf.shape(self.cos_block.d)[0]
+        return rhs[..., :M, :], rhs[..., M:, :]
+
+    def _matmul(self, x, adjoint=False, adjoint_arg=False):
+        # self-adjoint, so we can ignore `adjoint`
+        x_cos, x_sin = self._split(x, adjoint_arg)
+        y_cos = self.cos_block.matmul(x_cos)
+        y_sin = self.sin_block.matmul(x_sin)
+        return tf.concat([y_cos, y_sin], axis=-2)
+
+    def _solve(self, rhs, adjoint=False, adjoint_arg=False):
+        # self-adjoint, so we can ignore `adjoint`
+        rhs_cos, rhs_sin = self._split(rhs, adjoint_arg)
+        x_cos = self.cos_block.solve(rhs_cos)
+        x_sin = self.sin_block.solve(rhs_sin)
+        return tf.concat([x_cos, x_sin], axis=-2)
+
+    def solve_split(self, Kuf):
+        """
+        Kuu⁻¹ Kuf for a VFFKuf, block by block; returns a VFFKuf
+        """
+        return VFFKuf(
+            self.cos_block.solve(Kuf.cos), self.sin_block.solve(Kuf.sin)
+        )
+
+    def _log_abs_determinant(self):
+        logdet_cos = self.cos_block.log_abs_determinant()
+        logdet_sin = self.sin_block.log_abs_determinant()
+        return logdet_cos + logdet_sin
+
+    def trace_solve_outer(self, L):
+        """
+        tr(Kuu⁻¹ L Lᵀ), computed block-wise without forming Kuu⁻¹ L
+        """
+        L_cos, L_sin = self._split(L, adjoint_arg=False)
+        trace_cos = self.cos_block.trace_solve_outer(L_cos)
+        trace_sin = self.sin_block.trace_solve_outer(L_sin)
+        return trace_cos + trace_sin
+
+    def _to_dense(self):
+        return _block_diag(self.cos_block.to_dense(), self.sin_block.to_dense())
+
+    def inverse(self, name="inverse"):
+        return _VFFKuuInverse(self, name=name)
+
+
+class _VFFKuuInverse(tf.linalg.LinearOperatorInversion):
+    """
+    Kuu⁻¹, which is only materialised when to_dense() is called, and then
+    analytically, without a Cholesky decomposition.
+    """
+
+    def __init__(self, operator, name):
+        super().__init__(
+            operator,
+            is_non_singular=True,
+            is_self_adjoint=True,
+            is_positive_definite=True,
+            is_square=True,
+            name=name,
+        )
+
+    def _to_dense(self):
+        return _block_diag(
+            self.operator.cos_block.inverse_to_dense(),
+            self.operator.sin_block.inverse_to_dense(),
+        )
+
 
 # %%
 import matplotlib.pyplot as plt
@@ -62,8 +292,20 @@ class FourierFeatures1D(InducingVariables):
         self.a = gpflow.Parameter(a, dtype=gpflow.default_float())
         self.b = gpflow.Parameter(b, dtype=gpflow.default_float())
         self.M = M
-        # integer array defining the frequencies, ω_m = 2π (b - a)/m:
-        self.ms = np.arange(M)
+        # integer array defining the frequencies, ω_m = 2π m / (b - a); it and
+        # the arrays below only depend on M, so we build them once:
+        ms = np.arange(M)
+        self._ms_float = tf.constant(ms, dtype=gpflow.default_float())
+        # the sine block does not include ω_0 = 0, so it starts at m = 1:
+        self._ms_sin_float = tf.constant(ms[1:], dtype=gpflow.default_float())
+        # the cosine blocks of Kuu scale ω_0 = 0 differently; selecting it
+        # by m avoids comparing the (floating-point) ω_m to zero:
+        self._two_or_four = tf.constant(
+            np.where(ms == 0, 2.0, 4.0), dtype=gpflow.default_float()
+        )
+        self._four_or_eight = tf.constant(
+            np.where(ms == 0, 4.0, 8.0), dtype=gpflow.default_float()
+        )
 
     @property
     def num_inducing(self):
@@ -81,128 +323,229 @@ class FourierFeatures1D(InducingVariables):
 # %% [markdown]
 # Next, we need to define how to compute $\mathrm{K}_\mathbf{uu} = \operatorname{cov}(u_m, u_{m'})$ (eq. (61)) and $\mathrm{K}_\mathbf{uf} = \operatorname{cov}(u_m, f(x_n))$ (eq. (60)).
 
+# %% [markdown]
+# These computations are short chains of elementwise operations, small reductions and broadcasts over the $M \times N$ matrix `Kuf`, which XLA can fuse into a single pass. We therefore write them as functions of plain tensors, and compile them with XLA when the environment variable `GPFLOW_VFF_XLA=1` is set. (Note that XLA compiles one version per input shape.) Otherwise, we still run each of them as a single `tf.function` graph: for a small number of frequencies, dispatching their ops one by one in eager mode (e.g. for predictions outside a compiled training loop) costs more than the computations themselves.
+
 # %%
-@cov.Kuu.register(FourierFeatures1D, gpflow.kernels.Matern12)
-def Kuu_matern12_fourierfeatures1d(inducing_variable, kernel, jitter=None):
-    a, b, ms = (lambda u: (u.a, u.b, u.ms))(inducing_variable)
-    omegas = 2.0 * np.pi * ms / (b - a)
+USE_XLA = os.environ.get("GPFLOW_VFF_XLA", "0") == "1"
+
+
+def _maybe_xla(func):
+    """ compile `func` with XLA if GPFLOW_VFF_XLA=1, else into a plain graph """
+    if USE_XLA:
+        # `jit_compile` was called `experimental_compile` before TF 2.5
+        if Version(tf.__version__) >= Version("2.5"):
+            return tf.function(func, jit_compile=True)
+        return tf.function(func, experimental_compile=True)
+    # don't retrace for every new shape (e.g. varying N); `reduce_retracing`
+    # was called `experimental_relax_shapes` before TF 2.9
+    if Version(tf.__version__) >= Version("2.9"):
+        return tf.function(func, reduce_retracing=True)
+    return tf.function(func, experimental_relax_shapes=True)
+
+
+def _as_tensors(*values):
+    return tuple(tf.convert_to_tensor(value) for value in values)
+
+
+# %%
+@_maybe_xla
+def _Kuu_matern12(a, b, lengthscales, variance, ms, ms_sin, two_or_four):
+    omegas = (2.0 * np.pi / (b - a)) * ms
+    omegas_sin = (2.0 * np.pi / (b - a)) * ms_sin
 
     # Cosine block:
-    lamb = 1.0 / kernel.lengthscales
-    two_or_four = to_default_float(tf.where(omegas == 0, 2.0, 4.0))
+    lamb = 1.0 / lengthscales
     d_cos = (
         (b - a)
         * (tf.square(lamb) + tf.square(omegas))
         / lamb
-        / kernel.variance
+        / variance
         / two_or_four
     )  # eq. (111)
-    v_cos = tf.ones_like(d_cos) / tf.sqrt(kernel.variance)  # eq. (110)
-    cosine_block = LowRank(
-        Diag(d_cos, is_positive_definite=True), v_cos[:, None]
-    )
+    v_cos = tf.ones_like(d_cos) / tf.sqrt(variance)  # eq. (110)
 
     # Sine block:
-    omegas = omegas[
-        tf.not_equal(omegas, 0)
-    ]  # the sine block does not include omega=0
     d_sin = (
         (b - a)
-        * (tf.square(lamb) + tf.square(omegas))
+        * (tf.square(lamb) + tf.square(omegas_sin))
         / lamb
-        / kernel.variance
+        / variance
         / 4.0
     )  # eq. (113)
-    sine_block = Diag(d_sin, is_positive_definite=True)
 
-    return BlockDiag([cosine_block, sine_block])
+    return d_cos, v_cos, d_sin
 
 
-@cov.Kuf.register(FourierFeatures1D, gpflow.kernels.Matern12, TensorLike)
-def Kuf_matern12_fourierfeatures1d(inducing_variable, kernel, X):
-    X = tf.squeeze(X, axis=1)
-    a, b, ms = (lambda u: (u.a, u.b, u.ms))(inducing_variable)
+@cov.Kuu.register(FourierFeatures1D, gpflow.kernels.Matern12)
+def Kuu_matern12_fourierfeatures1d(inducing_variable, kernel, jitter=None):
+    u = inducing_variable
+    d_cos, v_cos, d_sin = _Kuu_matern12(
+        *_as_tensors(u.a, u.b, kernel.lengthscales, kernel.variance),
+        u._ms_float,
+        u._ms_sin_float,
+        u._two_or_four,
+    )
+    return VFFKuu(d_cos, v_cos, d_sin)
+
+
+def _cos_sin(omegas, X_minus_a):
+    """
+    cos(ω (X - a)) and sin(ω (X - a)) from a single complex exponential,
+    exp(iθ) = cos θ + i sin θ, so the argument θ is only swept once.
+    The sine of the zero frequency is dropped.
+    """
+    theta = omegas[:, None] * X_minus_a[None, :]
+    z = tf.exp(tf.complex(tf.zeros_like(theta), theta))
+    return tf.math.real(z), tf.math.imag(z)[1:]
+
+
+def _Kuf_args(X, a, b):
+    """
+    The N-vector terms of Kuf that only depend on X [N] and [a, b]:
+    X - a, whether each point is inside [a, b], and otherwise its (signed)
+    distance to the interval.
+    """
+    X_minus_a = X - a  # shared by the Fourier and left-tail terms
+    inside = (X >= a) & (X <= b)
+    delta_X = tf.where(X < a, X_minus_a, X - b)  # distance to [a, b]
+    return X_minus_a, inside, delta_X
 
-    omegas = 2.0 * np.pi * ms / (b - a)
-    Kuf_cos = tf.cos(omegas[:, None] * (X[None, :] - a))
-    omegas_sin = omegas[tf.not_equal(omegas, 0)]  # don't compute zero frequency
-    Kuf_sin = tf.sin(omegas_sin[:, None] * (X[None, :] - a))
+
+@_maybe_xla
+def _Kuf_matern12(X, a, b, lengthscales, ms):
+    X_minus_a, inside, delta_X = _Kuf_args(X, a, b)
+    omegas = (2.0 * np.pi / (b - a)) * ms
+    Kuf_cos, Kuf_sin = _cos_sin(omegas, X_minus_a)
 
     # correct Kuf outside [a, b] -- see Table 1
-    Kuf_sin = tf.where(
-        (X < a) | (X > b), tf.zeros_like(Kuf_sin), Kuf_sin
-    )  # just zero
+    # The tails only depend on X, so we select them on the N-vector and
+    # then write all M x N entries in a single pass:
+    def with_tails():
+        tail_cos = tf.exp(-tf.abs(delta_X) / lengthscales)
+        return VFFKuf(
+            tf.where(inside[None, :], Kuf_cos, tail_cos[None, :]),
+            Kuf_sin * tf.cast(inside, Kuf_sin.dtype)[None, :],  # just zero
+        )
+
+    # skip the M x N pass entirely when all of X is inside [a, b]
+    return tf.cond(
+        tf.reduce_all(inside), lambda: VFFKuf(Kuf_cos, Kuf_sin), with_tails
+    )
 
-    left_tail = tf.exp(-tf.abs(X - a) / kernel.lengthscales)[None, :]
-    right_tail = tf.exp(-tf.abs(X - b) / kernel.lengthscales)[None, :]
-    Kuf_cos = tf.where(X < a, left_tail, Kuf_cos)  # replace with left tail
-    Kuf_cos = tf.where(X > b, right_tail, Kuf_cos)  # replace with right tail
 
-    return tf.concat([Kuf_cos, Kuf_sin], axis=0)
+@cov.Kuf.register(FourierFeatures1D, gpflow.kernels.Matern12, TensorLike)
+def Kuf_matern12_fourierfeatures1d(inducing_variable, kernel, X):
+    u = inducing_variable
+    return _Kuf_matern12(
+        tf.squeeze(X, axis=1),
+        *_as_tensors(u.a, u.b, kernel.lengthscales),
+        u._ms_float,
+    )
 
 
-@cov.Kuu.register(FourierFeatures1D, gpflow.kernels.Matern32)
-def Kuu_matern32_fourierfeatures1d(inducing_variable, kernel, jitter=None):
-    a, b, ms = (lambda u: (u.a, u.b, u.ms))(inducing_variable)
-    omegas = 2.0 * np.pi * ms / (b - a)
+@_maybe_xla
+def _Kuu_matern32(a, b, lengthscales, variance, ms, ms_sin, four_or_eight):
+    omegas = (2.0 * np.pi / (b - a)) * ms
+    omegas_sin = (2.0 * np.pi / (b - a)) * ms_sin
 
     # Cosine block: eq. (114)
-    lamb = np.sqrt(3.0) / kernel.lengthscales
-    four_or_eight = to_default_float(tf.where(omegas == 0, 4.0, 8.0))
+    lamb = np.sqrt(3.0) / lengthscales
     d_cos = (
         (b - a)
         * tf.square(tf.square(lamb) + tf.square(omegas))
         / tf.pow(lamb, 3)
-        / kernel.variance
+        / variance
         / four_or_eight
     )
-    v_cos = tf.ones_like(d_cos) / tf.sqrt(kernel.variance)
-    cosine_block = LowRank(
-        Diag(d_cos, is_positive_definite=True), v_cos[:, None]
-    )
+    v_cos = tf.ones_like(d_cos) / tf.sqrt(variance)
 
     # Sine block: eq. (115)
-    omegas = omegas[tf.not_equal(omegas, 0)]  # don't compute omega=0
     d_sin = (
         (b - a)
-        * tf.square(tf.square(lamb) + tf.square(omegas))
+        * tf.square(tf.square(lamb) + tf.square(omegas_sin))
         / tf.pow(lamb, 3)
-        / kernel.variance
+        / variance
         / 8.0
     )
-    v_sin = omegas / lamb / tf.sqrt(kernel.variance)
-    sine_block = LowRank(Diag(d_sin, is_positive_definite=True), v_sin[:, None])
+    v_sin = omegas_sin / lamb / tf.sqrt(variance)
 
-    return BlockDiag([cosine_block, sine_block])  # eq. (116)
+    return d_cos, v_cos, d_sin, v_sin
 
 
-@cov.Kuf.register(FourierFeatures1D, gpflow.kernels.Matern32, TensorLike)
-def Kuf_matern32_fourierfeatures1d(inducing_variable, kernel, X):
-    X = tf.squeeze(X, axis=1)
-    a, b, ms = (lambda u: (u.a, u.b, u.ms))(inducing_variable)
-    omegas = 2.0 * np.pi * ms / (b - a)
+@cov.Kuu.register(FourierFeatures1D, gpflow.kernels.Matern32)
+def Kuu_matern32_fourierfeatures1d(inducing_variable, kernel, jitter=None):
+    u = inducing_variable
+    d_cos, v_cos, d_sin, v_sin = _Kuu_matern32(
+        *_as_tensors(u.a, u.b, kernel.lengthscales, kernel.variance),
+        u._ms_float,
+        u._ms_sin_float,
+        u._four_or_eight,
+    )
+    return VFFKuu(d_cos, v_cos, d_sin, v_sin)  # eq. (116)
+
+
+@_maybe_xla
+def _Kuf_matern32(X, a, b, lengthscales, ms, ms_sin):
+    X_minus_a, inside, delta_X = _Kuf_args(X, a, b)
+    omegas = (2.0 * np.pi / (b - a)) * ms
+    omegas_sin = (2.0 * np.pi / (b - a)) * ms_sin
 
-    Kuf_cos = tf.cos(omegas[:, None] * (X[None, :] - a))
-    omegas_sin = omegas[tf.not_equal(omegas, 0)]  # don't compute zeros freq.
-    Kuf_sin = tf.sin(omegas_sin[:, None] * (X[None, :] - a))
+    Kuf_cos, Kuf_sin = _cos_sin(omegas, X_minus_a)
 
     # correct Kuf outside [a, b] -- see Table 1
+    # Left and right tails have the same form in the distance to [a, b],
+    # so we compute each tail once and write Kuf in a single pass:
+    def with_tails():
+        arg = np.sqrt(3) * tf.abs(delta_X) / lengthscales
+        exp_arg = tf.exp(-arg)
+
+        tail_cos = (1 + arg) * exp_arg
+        tail_sin = omegas_sin[:, None] * (delta_X * exp_arg)[None, :]
+        return VFFKuf(
+            tf.where(inside[None, :], Kuf_cos, tail_cos[None, :]),
+            tf.where(inside[None, :], Kuf_sin, tail_sin),
+        )
+
+    # skip the M x N pass entirely when all of X is inside [a, b]
+    return tf.cond(
+        tf.reduce_all(inside), lambda: VFFKuf(Kuf_cos, Kuf_sin), with_tails
+    )
 
-    def tail_cos(delta_X):
-        arg = np.sqrt(3) * tf.abs(delta_X) / kernel.lengthscales
-        return (1 + arg) * tf.exp(-arg)[None, :]
 
-    Kuf_cos = tf.where(X < a, tail_cos(X - a), Kuf_cos)
-    Kuf_cos = tf.where(X > b, tail_cos(X - b), Kuf_cos)
+@cov.Kuf.register(FourierFeatures1D, gpflow.kernels.Matern32, TensorLike)
+def Kuf_matern32_fourierfeatures1d(inducing_variable, kernel, X):
+    u = inducing_variable
+    return _Kuf_matern32(
+        tf.squeeze(X, axis=1),
+        *_as_tensors(u.a, u.b, kernel.lengthscales),
+        u._ms_float,
+        u._ms_sin_float,
+    )
 
-    def tail_sin(delta_X):
-        arg = np.sqrt(3) * tf.abs(delta_X) / kernel.lengthscales
-        return delta_X[None, :] * tf.exp(-arg) * omegas_sin[:, None]
 
-    Kuf_sin = tf.where(X < a, tail_sin(X - a), Kuf_sin)
-    Kuf_sin = tf.where(X > b, tail_sin(X - b), Kuf_sin)
+# %% [markdown]
+# Let's check that the structured operations on `Kuu` agree with dense linear algebra on the matrix it represents:
 
-    return tf.concat([Kuf_cos, Kuf_sin], axis=0)
+# %%
+rng = np.random.RandomState(0)
+for kernel in [gpflow.kernels.Matern12(), gpflow.kernels.Matern32()]:
+    Kuu = cov.Kuu(FourierFeatures1D(-0.5, 1.5, 5), kernel)
+    Kuu_dense = Kuu.to_dense().numpy()
+    rhs = rng.randn(Kuu_dense.shape[0], 3)
+    L = np.tril(rng.randn(*Kuu_dense.shape))
+
+    np.testing.assert_allclose(Kuu.solve(rhs), np.linalg.solve(Kuu_dense, rhs))
+    np.testing.assert_allclose(
+        Kuu.log_abs_determinant(), np.linalg.slogdet(Kuu_dense)[1]
+    )
+    np.testing.assert_allclose(
+        Kuu.inverse().to_dense(), np.linalg.inv(Kuu_dense)
+    )
+    np.testing.assert_allclose(
+        Kuu.trace_solve_outer(L),
+        np.trace(np.linalg.solve(Kuu_dense, L @ L.T)),
+    )
 
 
 # %% [markdown]
@@ -216,6 +559,14 @@ def prior_kl_vff(inducing_variable, kernel, q_mu, q_sqrt, whiten=False):
     if whiten:
         raise NotImplementedError
     K = cov.Kuu(inducing_variable, kernel)
+    if USE_XLA:
+        return _gauss_kl_vff_structured(
+            *_as_tensors(q_mu, q_sqrt),
+            K.cos_block.d,
+            K.cos_block.v,
+            K.sin_block.d,
+            K.sin_block.v,
+        )
     return gauss_kl_vff(q_mu, q_sqrt, K)
 
 
@@ -231,8 +582,8 @@ def gauss_kl_vff(q_mu, q_sqrt, K):
     q_sqrt is a matrix that is the lower triangular square-root matrix of the covariance of q.
 
     K is a positive definite matrix: the covariance of p.
-    NOTE: K is a LinearOperator that provides efficient methjods
-        for solve(), log_abs_determinant(), and trace()
+    NOTE: K is a LinearOperator (VFFKuu) that provides efficient methods
+        for solve() and log_abs_determinant()
     """
     # KL(N₀ || N₁) = ½ [tr(Σ₁⁻¹ Σ₀) + (μ₁ - μ₀)ᵀ Σ₁⁻¹ (μ₁ - μ₀) - k + ln(det(Σ₁)/det(Σ₀))]
     # N₀ = q; μ₀ = q_mu, Σ₀ = q_sqrt q_sqrtᵀ
@@ -240,6 +591,9 @@ def gauss_kl_vff(q_mu, q_sqrt, K):
     # KL(q || p) =
     #     ½ [tr(K⁻¹ q_sqrt q_sqrtᵀA + q_muᵀ K⁻¹ q_mu - k + logdet(K) - logdet(q_sqrt q_sqrtᵀ)]
     # k = number of dimensions, if q_sqrt is m x m this is m²
+    if q_sqrt.shape.ndims == 3 and q_sqrt.shape[0] == 1:
+        return _gauss_kl_vff_single_latent(q_mu, q_sqrt[0], K)
+
     Kinv_q_mu = K.solve(q_mu)
 
     mahalanobis_term = tf.squeeze(tf.matmul(q_mu, Kinv_q_mu, transpose_a=True))
@@ -248,9 +602,10 @@ def gauss_kl_vff(q_mu, q_sqrt, K):
     num_latent_gps = to_default_float(tf.shape(q_mu)[1])
     logdet_prior = num_latent_gps * K.log_abs_determinant()
 
-    product_of_dimensions__int = tf.reduce_prod(
-        tf.shape(q_sqrt)[:-1]
-    )  # dimensions are integers
+    # dimensions are integers, and statically known in practice
+    product_of_dimensions__int = q_sqrt.shape[:-1].num_elements()
+    if product_of_dimensions__int is None:
+        product_of_dimensions__int = tf.reduce_prod(tf.shape(q_sqrt)[:-1])
     constant_term = to_default_float(product_of_dimensions__int)
 
     Lq = tf.linalg.band_part(q_sqrt, -1, 0)  # force lower triangle
@@ -258,9 +613,13 @@ def gauss_kl_vff(q_mu, q_sqrt, K):
 
     # S = tf.matmul(q_sqrt, q_sqrt, transpose_b=True)
     # trace_term = tf.trace(K.solve(S))
-    trace_term = tf.squeeze(
-        tf.reduce_sum(Lq * K.solve(Lq), axis=[-1, -2])
-    )  # [O(N²) instead of O(N³)
+    if isinstance(K, VFFKuu):
+        # exploit the block-diagonal diagonal-plus-rank-one structure
+        trace_term = tf.squeeze(K.trace_solve_outer(Lq))
+    else:
+        trace_term = tf.squeeze(
+            tf.reduce_sum(Lq * K.solve(Lq), axis=[-1, -2])
+        )  # [O(N²) instead of O(N³)
 
     twoKL = (
         trace_term + mahalanobis_term - constant_term + logdet_prior - logdet_q
@@ -268,11 +627,86 @@ def gauss_kl_vff(q_mu, q_sqrt, K):
     return 0.5 * twoKL
 
 
+def _gauss_kl_vff_single_latent(q_mu, Lq, K):
+    """
+    gauss_kl_vff for a single latent GP (num_latent_gps == 1), which is how
+    VFF is used in practice: q_mu is [M, 1] and Lq is the [M, M] square-root
+    of the covariance of q.
+
+    NOTE: Lq must already be lower triangular (as GPflow's q_sqrt
+        parameters are); unlike gauss_kl_vff we do not enforce this.
+    """
+    Kinv_q_mu = K.solve(q_mu)
+    mahalanobis_term = tf.reduce_sum(q_mu * Kinv_q_mu)
+
+    logdet_prior = K.log_abs_determinant()
+
+    # use the static number of inducing variables when available
+    num_inducing = Lq.shape[0]
+    if num_inducing is None:
+        num_inducing = tf.shape(Lq)[0]
+    constant_term = to_default_float(num_inducing)
+
+    logdet_q = tf.reduce_sum(tf.math.log(tf.square(tf.linalg.diag_part(Lq))))
+
+    if isinstance(K, VFFKuu):
+        trace_term = K.trace_solve_outer(Lq)
+    else:
+        trace_term = tf.reduce_sum(Lq * K.solve(Lq))
+
+    twoKL = (
+        trace_term + mahalanobis_term - constant_term + logdet_prior - logdet_q
+    )
+    return 0.5 * twoKL
+
+
+@_maybe_xla
+def _gauss_kl_vff_structured(q_mu, q_sqrt, d_cos, v_cos, d_sin, v_sin):
+    """
+    gauss_kl_vff for K = VFFKuu(d_cos, v_cos, d_sin, v_sin), taking plain
+    tensors so that it can be compiled by XLA
+    """
+    return gauss_kl_vff(q_mu, q_sqrt, VFFKuu(d_cos, v_cos, d_sin, v_sin))
+
+
 # %%
 import gpflow.posteriors
 
 
 class VFFPosterior(gpflow.posteriors.BasePosterior):
+    def __init__(
+        self,
+        kernel,
+        inducing_variable,
+        q_mu,
+        q_sqrt,
+        whiten=True,
+        mean_function=None,
+        *,
+        precompute_cache,
+        precompute_cache_dtype=None,
+    ):
+        """
+        The prediction-time mean product Kufᵀ alpha is bandwidth-bound;
+        `precompute_cache_dtype` (e.g. tf.bfloat16) stores alpha in a lower
+        precision, and computes the mean in it. The variances always use
+        gpflow.default_float(): Kufᵀ Qinv Kuf nearly cancels with the prior
+        variance, so in bfloat16 they would be unusable. None keeps
+        gpflow.default_float(). Only affects predictions with a precomputed
+        cache, not training.
+        """
+        # set before super().__init__(), which may already build the cache
+        self.precompute_cache_dtype = precompute_cache_dtype
+        super().__init__(
+            kernel,
+            inducing_variable,
+            q_mu,
+            q_sqrt,
+            whiten,
+            mean_function,
+            precompute_cache=precompute_cache,
+        )
+
     def _conditional_fused(self, Xnew, full_cov, full_output_cov):
         """
         Xnew is a tensor with the points of the data or minibatch, shape N x D
@@ -287,18 +721,18 @@ class VFFPosterior(gpflow.posteriors.BasePosterior):
         num_func = tf.shape(f)[1]  # K
 
         Kuu = cov.Kuu(self.X_data, self.kernel)  # this is now a LinearOperator
-        Kuf = cov.Kuf(self.X_data, self.kernel, Xnew)  # still a Tensor
+        # a VFFKuf: we never form the dense Kuf, all products with it are
+        # computed as sums over its cosine and sine blocks
+        Kuf = cov.Kuf(self.X_data, self.kernel, Xnew)
 
-        KuuInv_Kuf = Kuu.solve(Kuf)
+        KuuInv_Kuf = Kuu.solve_split(Kuf)  # also a VFFKuf
 
         # compute the covariance due to the conditioning
         if full_cov:
-            fvar = self.kernel(Xnew) - tf.matmul(
-                Kuf, KuuInv_Kuf, transpose_a=True
-            )
+            fvar = self.kernel(Xnew) - Kuf.matmul_transpose(KuuInv_Kuf)
             shape = (num_func, 1, 1)
         else:
-            KufT_KuuInv_Kuf_diag = tf.reduce_sum(Kuf * KuuInv_Kuf, axis=-2)
+            KufT_KuuInv_Kuf_diag = Kuf.diag_matmul_transpose(KuuInv_Kuf)
             fvar = self.kernel(Xnew, full_cov=False) - KufT_KuuInv_Kuf_diag
             shape = (num_func, 1)
         fvar = tf.expand_dims(fvar, 0) * tf.ones(
@@ -311,7 +745,7 @@ class VFFPosterior(gpflow.posteriors.BasePosterior):
         A = KuuInv_Kuf
 
         # construct the conditional mean
-        fmean = tf.matmul(A, f, transpose_a=True)
+        fmean = A.matmul_transpose(f)
 
         if q_sqrt is not None:
             if q_sqrt.get_shape().ndims == 2:
@@ -328,7 +762,8 @@ class VFFPosterior(gpflow.posteriors.BasePosterior):
                 # TODO the following won't work for K > 1
                 assert q_sqrt.shape[0] == 1
                 # LTA = (A.T @ DenseMatrix(q_sqrt[:,:,0])).T.get()[None, :, :]
-                ATL = tf.matmul(A, q_sqrt, transpose_a=True)
+                # with K = 1, a single N x M matmul (no K axis) is enough:
+                ATL = A.matmul_transpose(q_sqrt[0])  # N x M
             else:
                 raise ValueError(
                     "Bad dimension for q_sqrt: %s"
@@ -336,10 +771,10 @@ class VFFPosterior(gpflow.posteriors.BasePosterior):
                 )
             if full_cov:
                 # fvar = fvar + tf.matmul(LTA, LTA, transpose_a=True)  # K x N x N
-                fvar = fvar + tf.matmul(ATL, ATL, transpose_b=True)  # K x N x N
+                fvar = fvar + tf.einsum("nm,pm->np", ATL, ATL)  # K x N x N
             else:
                 # fvar = fvar + tf.reduce_sum(tf.square(LTA), 1)  # K x N
-                fvar = fvar + tf.reduce_sum(tf.square(ATL), 2)  # K x N
+                fvar = fvar + tf.reduce_sum(tf.square(ATL), -1)  # K x N
 
         if not full_cov:
             fvar = tf.transpose(fvar)  # N x K
@@ -350,7 +785,9 @@ class VFFPosterior(gpflow.posteriors.BasePosterior):
     # to speed up predictions:
 
     def _precompute(self):
-        Kuu = cov.Kuu(self.X_data, self.kernel)  # this is now a LinearOperator
+        # this is now a VFFKuu, so the solves and the dense inverse below all
+        # reuse the same Sherman–Morrison terms, without any Cholesky:
+        Kuu = cov.Kuu(self.X_data, self.kernel)
 
         q_mu = self._q_dist.q_mu
         q_sqrt = self._q_dist.q_sqrt
@@ -372,6 +809,9 @@ class VFFPosterior(gpflow.posteriors.BasePosterior):
 
         Qinv = Kuu.inverse().to_dense() - KuuInv_covu_KuuInv
 
+        if self.precompute_cache_dtype is not None:
+            alpha = tf.cast(alpha, self.precompute_cache_dtype)
+
         return gpflow.posteriors.PrecomputedValue.wrap_alpha_Qinv(alpha, Qinv)
 
     def _conditional_with_precompute(
@@ -382,26 +822,50 @@ class VFFPosterior(gpflow.posteriors.BasePosterior):
         if full_output_cov:
             raise NotImplementedError
 
-        Kuf = cov.Kuf(self.X_data, self.kernel, Xnew)  # still a Tensor
+        Kuf = cov.Kuf(self.X_data, self.kernel, Xnew)  # a VFFKuf
 
-        # construct the conditional mean
-        fmean = tf.matmul(Kuf, alpha, transpose_a=True)
+        # construct the conditional mean, in the dtype of alpha (see
+        # precompute_cache_dtype)
+        if Kuf.cos.dtype != alpha.dtype:
+            Kuf_alpha_dtype = VFFKuf(
+                *(tf.cast(block, alpha.dtype) for block in Kuf)
+            )
+            fmean = Kuf_alpha_dtype.matmul_transpose(alpha)
+            fmean = tf.cast(fmean, gpflow.default_float())
+        else:
+            fmean = Kuf.matmul_transpose(alpha)
 
         num_func = tf.shape(alpha)[1]  # K
-        Qinv_Kuf = tf.matmul(Qinv, Kuf)
+        Qinv_Kuf = Kuf.left_matmul(Qinv)
 
         # compute the covariance due to the conditioning
         if full_cov:
-            fvar = self.kernel(Xnew) - tf.matmul(
-                Kuf, Qinv_Kuf, transpose_a=True
-            )
+            fvar = self.kernel(Xnew) - Kuf.matmul_transpose(Qinv_Kuf)
         else:
-            KufT_Qinv_Kuf_diag = tf.reduce_sum(Kuf * Qinv_Kuf, axis=-2)
+            KufT_Qinv_Kuf_diag = Kuf.diag_matmul_transpose(Qinv_Kuf)
             fvar = self.kernel(Xnew, full_cov=False) - KufT_Qinv_Kuf_diag
             fvar = tf.transpose(fvar)
 
         return fmean, fvar
 
+    # Each call of predict_f computes a new Kuf and makes another pass over
+    # the precomputed cache, so callers doing many small predictions (e.g.
+    # looping over a test set) should prefer a single call over all points:
+
+    def predict_f_batched(self, Xnew_chunks):
+        """
+        predict_f (with full_cov=False) at each of the inputs in the list
+        `Xnew_chunks`, computed in a single call on their concatenation.
+        Returns a list with the (mean, var) of each chunk.
+        """
+        Xnew = tf.concat(Xnew_chunks, axis=0)
+        mean, var = self.predict_f(Xnew, full_cov=False)
+        sizes = tf.stack([tf.shape(X)[0] for X in Xnew_chunks])
+        num = len(Xnew_chunks)
+        return list(
+            zip(tf.split(mean, sizes, num=num), tf.split(var, sizes, num=num))
+        )
+
 
 # %% [markdown]
 # We now have to register our Posterior object: